@@ -1,16 +1,34 @@
 import imaplib
-import email
 import smtplib
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import lancedb
 import os
 import json
+import atexit
+import hashlib
+import threading
+import zlib
+try:
+    import fcntl
+except ImportError:  # Windows: the development server runs one process, so the thread lock is enough.
+    fcntl = None
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from langchain_community.vectorstores import LanceDB
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from flask import Flask, jsonify, request
 from dotenv import load_dotenv
+from imap_fetch import fetch_text_messages
+from email_parsing import is_greeting, parse_email
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,19 +40,162 @@ SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
 EMAIL_ACCOUNT = os.getenv('EMAIL_ACCOUNT')
 EMAIL_PASSWORD = os.getenv('EMAIL_APP_PASSWORD')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# Number of emails whose retrieval, Gemini and SMTP calls run concurrently on the worker pool.
+MAX_CONCURRENT_EMAILS = int(os.getenv('MAX_CONCURRENT_EMAILS', 8))
+# Persistent model cache so cold starts load the embedding weights from disk instead of re-downloading them.
+HF_CACHE_DIR = os.getenv('HF_HOME', '/tmp/hf_cache')
+# Set to "onnx" to run a dynamically int8-quantized ONNX export of the embedding model on ONNX Runtime.
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# Quantized export to load from the model repo when the ONNX backend is used (e.g. onnx/model_qint8_avx512_vnni.onnx).
+EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE', 'onnx/model_quint8_avx2.onnx')
 
 # --- STATIC CONFIGURATION ---
 DB_PATH = "/tmp/lancedb"
 TABLE_NAME = "pnb_faqs_filtered"
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Maximum number of message IDs per IMAP FETCH/STORE command. Larger sets can
+# exceed the server's maximum request size.
+FETCH_BATCH_SIZE = 100
+# Lock file that keeps email checks in different worker processes from overlapping.
+CHECK_LOCK_PATH = f"{DB_PATH}.check.lock"
+# Streaming endpoint: the reply arrives as server-sent events while it is being generated.
+GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+# (connect, read) timeouts in seconds for Gemini API calls.
+GEMINI_TIMEOUT = (5, 30)
+# Socket timeout in seconds for the SMTP connection.
+SMTP_TIMEOUT = 30
+# Socket timeout in seconds for the IMAP connection, so a silently dropped idle
+# connection fails the NOOP probe instead of blocking it forever.
+IMAP_TIMEOUT = 30
+# Number of generated replies kept in memory for repeated questions.
+REPLY_CACHE_SIZE = 512
+# Number of query embeddings memoized to skip the transformer forward pass on repeats.
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+# Minimum cosine similarity for a new question to reuse the reply of a cached one.
+SEMANTIC_CACHE_THRESHOLD = 0.95
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
 
+# --- Shared Gemini HTTP Session ---
+# Reusing one session keeps the TLS connections to the Gemini API alive between
+# calls instead of doing a fresh handshake for every email. The pool is sized so
+# every email worker can hold its own connection. Transient errors (rate limits,
+# 5xx) are retried with backoff; generation has no side effects, so POST is safe to retry.
+gemini_session = requests.Session()
+gemini_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_CONCURRENT_EMAILS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False,
+    ),
+))
+# The session lives as long as the process; close its pooled connections on shutdown.
+atexit.register(gemini_session.close)
+
+# --- Reply Cache ---
+# Many customers ask the same FAQ questions. Successful Gemini replies are cached
+# in memory: an exact-match LRU keyed on the normalized question, plus a semantic
+# tier that matches near-duplicate questions by embedding similarity.
+_reply_cache = OrderedDict()
+_semantic_embeddings = np.empty((0, 0), dtype=np.float32)
+_semantic_replies = []
+_cache_lock = threading.Lock()
+
+def _reply_cache_key(question):
+    normalized_question = ' '.join(question.lower().split())
+    return hashlib.blake2b(normalized_question.encode()).hexdigest()
+
+def _unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+def get_cached_reply(question, query_embedding=None):
+    """
+    Returns a previously generated reply for this question, or None.
+    Without an embedding only the exact-match tier is checked.
+    """
+    key = _reply_cache_key(question)
+    with _cache_lock:
+        if key in _reply_cache:
+            _reply_cache.move_to_end(key)
+            return _reply_cache[key]
+
+        if query_embedding is None or not _semantic_replies:
+            return None
+        similarities = _semantic_embeddings @ _unit_vector(query_embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return _semantic_replies[best]
+    return None
+
+def cache_reply(question, query_embedding, reply):
+    """Stores a successful reply in both cache tiers, evicting the oldest entries when full."""
+    global _semantic_embeddings
+    key = _reply_cache_key(question)
+    with _cache_lock:
+        _reply_cache[key] = reply
+        _reply_cache.move_to_end(key)
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+
+        if query_embedding is None:
+            return
+        vector = _unit_vector(query_embedding)
+        if not _semantic_replies:
+            _semantic_embeddings = vector[np.newaxis, :]
+        else:
+            _semantic_embeddings = np.vstack([_semantic_embeddings[-(REPLY_CACHE_SIZE - 1):], vector])
+        _semantic_replies.append(reply)
+        del _semantic_replies[:-REPLY_CACHE_SIZE]
+
+# --- Query Embedding Cache ---
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embedding model and memoizes `embed_query` on the whitespace-normalized text.
+    Document embeddings are passed through uncached.
+    """
+
+    def __init__(self, embeddings, maxsize=QUERY_EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self._embed_query = lru_cache(maxsize=maxsize)(self._embed_normalized_query)
+
+    def _embed_normalized_query(self, text):
+        # Stored as a tuple so callers can't mutate the cached vector.
+        return tuple(self.embeddings.embed_query(text))
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return list(self._embed_query(' '.join(text.split())))
+
 # --- Global Knowledge Base Object ---
 # This avoids reloading models on every single request.
+embedding_model = None
 knowledge_base = None
 
+def load_embedding_model():
+    """Loads the embedding model once. Safe to call before forking worker processes."""
+    global embedding_model
+    if embedding_model is None:
+        print("Loading embedding model...")
+        # Must match the embedding settings used by scraper.py to build the table.
+        model_kwargs = {"device": "cpu"}
+        if EMBEDDING_BACKEND == 'onnx':
+            model_kwargs.update(backend="onnx", model_kwargs={"file_name": EMBEDDING_ONNX_FILE})
+        embedding_model = CachedQueryEmbeddings(HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL_NAME,
+            cache_folder=HF_CACHE_DIR,
+            model_kwargs=model_kwargs,
+            encode_kwargs={"normalize_embeddings": True, "batch_size": 64},
+        ))
+    return embedding_model
+
 def initialize_knowledge_base():
     """Connects to the LanceDB table. This is called once before the first request."""
     global knowledge_base
@@ -43,89 +204,135 @@ def initialize_knowledge_base():
         if not os.path.exists(DB_PATH):
              raise FileNotFoundError(f"LanceDB database not found at {DB_PATH}. Please run the scraper script first.")
 
+        # The LanceDB connection is opened per process: its native runtime threads don't survive a fork.
         db = lancedb.connect(DB_PATH)
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        knowledge_base = LanceDB(connection=db, embedding=embeddings, table_name=TABLE_NAME)
+        knowledge_base = LanceDB(connection=db, embedding=load_embedding_model(), table_name=TABLE_NAME)
         print("Knowledge base connection successful.")
 
-def generate_gemini_reply(context, question):
+# With gunicorn's preload_app this runs once in the master process, so workers
+# inherit the model weights copy-on-write instead of each loading their own copy.
+# The ONNX backend is skipped: its InferenceSession owns a native thread pool that
+# doesn't survive a fork, so each worker builds its own session on first use.
+if os.getenv('PRELOAD_EMBEDDING_MODEL') == '1' and EMBEDDING_BACKEND != 'onnx':
+    load_embedding_model()
+
+def _iter_gemini_stream_text(response):
+    """Yields the text of each chunk of a streamed (alt=sse) Gemini response."""
+    for line in response.iter_lines():
+        # Each event is a single "data: {json}" line; other lines are blank separators.
+        if not line.startswith(b"data:"):
+            continue
+        chunk = json.loads(line[len(b"data:"):])
+        for candidate in chunk.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                if part.get("text"):
+                    yield part["text"]
+
+# --- Gemini Prompt ---
+# Sent as the API's systemInstruction, so each request only carries the context and question.
+SYSTEM_PROMPT = """You are "Arya", a professional and friendly customer service assistant for PNB Housing.
+
+Rules:
+1. Persona: Be polite, helpful and clear. Give detailed, useful answers, not just short ones.
+2. Greeting: Every response MUST begin with a friendly greeting, e.g. "Hello! I'm Arya from PNB Housing."
+3. Grounding: Base your answer strictly on the CONTEXT. Do not use outside knowledge.
+4. Missing information: If the CONTEXT does not contain the answer, reply exactly: "Hello! I'm Arya. I'm sorry, but I couldn't find specific information about your query in our knowledge base. I can assist with questions about PNB Housing's Home Loans and Fixed Deposits."
+
+Example:
+QUESTION: Can I open multiple accounts?
+CONTEXT: Question: Can a depositor open multiple accounts? Answer: Yes, you can open multiple accounts, but for the purpose of computation of tax liability all the accounts will be clubbed.
+ANSWER:
+Hello! I'm Arya.
+
+Yes, you can certainly open multiple Fixed Deposit accounts with PNB Housing. Please keep in mind that for the purpose of computing tax liability, all of your accounts will be clubbed together."""
+# Retrieved context beyond this many characters is dropped to bound prompt size.
+MAX_CONTEXT_CHARS = 2000
+
+# --- Greeting Reply ---
+# Canned reply for emails that email_parsing.is_greeting() treats as small talk.
+GREETING_REPLY = "Hello! I'm Arya, your PNB Housing assistant. How can I help you with our Home Loan or Fixed Deposit products today?"
+
+def generate_gemini_reply(context, question, query_embedding=None):
     """
     Generates a reply using the Gemini API with an improved prompt for better persona and response quality.
+    Successful replies are added to the reply cache, using `query_embedding` for the semantic tier.
     """
     print("Generating response with Gemini...")
 
-    # --- Step 1: Handle simple greetings and small talk ---
-    normalized_question = question.lower().strip()
-    greetings = ["hi", "hello", "hey", "how are you", "how are you?"]
-
-    # If the user's entire message is just a greeting, provide a canned response.
-    if normalized_question in greetings:
-        print("Detected simple greeting. Replying with a standard greeting.")
-        return "Hello! I'm Arya, your PNB Housing assistant. How can I help you with our Home Loan or Fixed Deposit products today?"
-    
-    # Also handle cases where the message is very short and likely just a greeting
-    if len(normalized_question.split()) <= 2 and any(g in normalized_question for g in greetings):
-        print("Detected short greeting. Replying with a standard greeting.")
-        return "Hello! I'm Arya, your PNB Housing assistant. How can I help you with our Home Loan or Fixed Deposit products today?"
-
-    # --- Step 2: Build the enhanced prompt for the LLM ---
-    prompt_template = f"""
-    You are "Arya", a professional and friendly customer service assistant for PNB Housing.
-
-    **Your Core Directives:**
-    1.  **Persona**: You are always polite, helpful, and clear. Your goal is to provide detailed and useful information, not just short answers.
-    2.  **Greeting**: Every single response MUST begin with a friendly greeting. Examples: "Hi there! I'm Arya.", "Hello! My name is Arya.", "Hello! I'm Arya from PNB Housing."
-    3.  **Grounding**: You MUST base your answers strictly on the information provided in the "CONTEXT" section. Do not use any outside knowledge.
-    4.  **Handling Missing Information**: If the CONTEXT does not contain the answer, you MUST reply with: "Hello! I'm Arya. I'm sorry, but I couldn't find specific information about your query in our knowledge base. I can assist with questions about PNB Housing's Home Loans and Fixed Deposits."
-
-    **Example of a Perfect Response:**
-    ---
-    USER'S QUESTION: Can I open multiple accounts?
-    CONTEXT: Question: Can a depositor open multiple accounts? Answer: Yes, you can open multiple accounts, but for the purpose of computation of tax liability all the accounts will be clubbed.
-    YOUR ANSWER:
-    Hello! I'm Arya.
-
-    Yes, you can certainly open multiple Fixed Deposit accounts with PNB Housing. Please keep in mind that for the purpose of computing tax liability, all of your accounts will be clubbed together.
-    ---
-
-    Now, answer the following user's question based on the provided context.
-
-    ---
-    CONTEXT:
-    {context}
-    ---
-
-    USER'S QUESTION:
-    {question}
-
-    YOUR ANSWER:
-    """
-
+    # --- Step 1: Build the request; the persona and rules travel as the system instruction ---
     headers = {'Content-Type': 'application/json'}
     payload = json.dumps({
-        "contents": [{"parts": [{"text": prompt_template.strip()}]}]
+        "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+        "contents": [{"parts": [{"text": f"CONTEXT:\n{context[:MAX_CONTEXT_CHARS]}\n\nQUESTION:\n{question}"}]}],
+        "generationConfig": {"maxOutputTokens": 512, "temperature": 0.2},
     })
 
-    # --- Step 3: Call the Gemini API ---
+    # --- Step 2: Call the Gemini API ---
     try:
-        response = requests.post(GEMINI_API_URL, headers=headers, data=payload)
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if "candidates" in result and result["candidates"][0]["content"]["parts"][0]["text"]:
-            return result["candidates"][0]["content"]["parts"][0]["text"].strip()
+        # The context manager returns the pooled connection even if reading the stream fails.
+        with gemini_session.post(GEMINI_API_URL, headers=headers, data=payload, timeout=GEMINI_TIMEOUT, stream=True) as response:
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as http_err:
+                # Read the error body while the streamed response is still open.
+                print(f"Gemini API HTTP error: {http_err} - {response.text}")
+                return "I am currently facing a technical issue and cannot reply at the moment. Please try again later."
+
+            # Chunks are consumed as they arrive, so the reply is ready as soon as generation ends.
+            reply = "".join(_iter_gemini_stream_text(response)).strip()
+
+        if reply:
+            cache_reply(question, query_embedding, reply)
+            return reply
         else:
             print("Gemini API returned an unexpected response structure.")
             return "I seem to be having a technical issue. Please try again in a moment."
 
-    except requests.exceptions.HTTPError as http_err:
-        print(f"Gemini API HTTP error: {http_err} - {response.text}")
-        return "I am currently facing a technical issue and cannot reply at the moment. Please try again later."
     except Exception as e:
         print(f"Error during Gemini API call: {e}")
         return "I am sorry, but I encountered an error while processing your request."
 
+# --- Persistent SMTP Connection ---
+# STARTTLS and LOGIN dominate the cost of sending a reply, so one authenticated
+# connection is reused for every reply. Workers share it under a lock; smtplib
+# uses PIPELINING on its own when the server advertises it.
+_smtp_conn = None
+_smtp_lock = threading.Lock()
+
+def close_smtp_connection():
+    """Closes the shared SMTP connection, ignoring errors from an already dead socket."""
+    global _smtp_conn
+    if _smtp_conn is None:
+        return
+    try:
+        _smtp_conn.quit()
+    except Exception:
+        pass
+    _smtp_conn = None
+
+def _send_message(msg):
+    """Sends a message over the shared SMTP connection, reconnecting once if the server dropped it."""
+    global _smtp_conn
+    with _smtp_lock:
+        for attempt in range(2):
+            if _smtp_conn is None:
+                server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+                server.starttls()
+                server.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
+                _smtp_conn = server
+            try:
+                _smtp_conn.send_message(msg)
+                return
+            except Exception as e:
+                close_smtp_connection()
+                # Idle connections are closed by the server, often after a "421" reply that
+                # smtplib reports as a refused command; retry once on a fresh one.
+                dropped = isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError)) or getattr(e, 'smtp_code', None) == 421
+                if attempt or not dropped:
+                    raise
+
+atexit.register(close_smtp_connection)
+
 def send_reply(to_address, subject, body):
     """Sends an email reply."""
     print(f"Sending reply to {to_address}...")
@@ -136,72 +343,238 @@ def send_reply(to_address, subject, body):
         msg['Subject'] = f"Re: {subject}"
         msg.attach(MIMEText(body, 'plain'))
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-            server.send_message(msg)
+        _send_message(msg)
         print("Reply sent successfully.")
         return True
     except Exception as e:
         print(f"Failed to send reply: {e}")
         return False
 
-def check_and_process_emails():
-    """The core logic to fetch and process unread emails."""
-    print("\nChecking for new emails...")
-    processed_count = 0
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
+# --- IMAP Compression (RFC 4978) ---
+# imaplib has no COMPRESS command; register it so _simple_command accepts it.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class DeflateIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    IMAP4_SSL with support for the COMPRESS=DEFLATE extension.
+    Once enabled, everything sent is deflated and everything read is inflated,
+    which shrinks message bodies on the wire several times over.
+    """
+    _compressor = None
+
+    def enable_compression(self):
+        """Turns on DEFLATE compression if the server advertises it. Returns True if enabled."""
+        # Servers often advertise COMPRESS only after LOGIN, so ask for fresh capabilities.
+        typ, data = self.capability()
+        if typ != 'OK' or b'COMPRESS=DEFLATE' not in data[-1].upper().split():
+            return False
+        typ, _ = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._inflated = bytearray()
+        return True
+
+    def _inflate_more(self):
+        data = self.file.read1(65536)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self._inflated += self._decompressor.decompress(data)
+
+    def read(self, size):
+        if self._compressor is None:
+            return super().read(size)
+        while len(self._inflated) < size:
+            self._inflate_more()
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        return data
+
+    def readline(self):
+        if self._compressor is None:
+            return super().readline()
+        while (end := self._inflated.find(b'\n') + 1) == 0:
+            self._inflate_more()
+        line = bytes(self._inflated[:end])
+        del self._inflated[:end]
+        return line
+
+    def send(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+# --- Persistent IMAP Connection ---
+# Connecting costs a TLS handshake plus LOGIN and SELECT round-trips, so a single
+# logged-in connection is kept open between checks and only rebuilt when it drops.
+_imap_conn = None
+_imap_lock = threading.Lock()
+
+def get_imap_connection():
+    """
+    Returns a live IMAP connection with the inbox selected, reconnecting if the old one dropped.
+    The caller must hold _imap_lock.
+    """
+    global _imap_conn
+    if _imap_conn is not None:
+        try:
+            _imap_conn.noop()
+        except (imaplib.IMAP4.error, OSError) as e:
+            print(f"IMAP connection lost ({e}). Reconnecting...")
+            close_imap_connection()
+
+    if _imap_conn is None:
+        print("Connecting to IMAP server...")
+        mail = DeflateIMAP4_SSL(IMAP_SERVER, timeout=IMAP_TIMEOUT)
         mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-        mail.select('inbox')
-        status, messages = mail.search(None, 'UNSEEN')
-        if status != 'OK' or not messages[0]:
-            print("No new unread emails.")
-            mail.logout()
-            return "No new emails to process."
-
-        email_ids = messages[0].split()
-        print(f"Found {len(email_ids)} new email(s).")
-
-        for email_id in email_ids:
-            _, msg_data = mail.fetch(email_id, '(RFC822)')
-            msg = email.message_from_bytes(msg_data[0][1])
-            
-            from_header = email.utils.getaddresses([msg['From']])
-            if not from_header: continue
-            sender_name, sender_address = from_header[0]
-            if '@' not in sender_address: continue
-
-            subject_header = email.header.decode_header(msg['Subject'])
-            subject = subject_header[0][0]
-            if isinstance(subject, bytes): subject = subject.decode(subject_header[0][1] or 'utf-8')
-
-            body = ""
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_type() == "text/plain":
-                        body = part.get_payload(decode=True).decode()
-                        break
-            else:
-                body = msg.get_payload(decode=True).decode()
-
-            print(f"\n--- Processing email from: {sender_address} ---")
-            user_query = f"Subject: {subject}\n\n{body}"
-
-            retrieved_docs = knowledge_base.similarity_search(user_query, k=3)
-            context = "\n\n".join([doc.page_content for doc in retrieved_docs])
-            generated_answer = generate_gemini_reply(context, user_query)
-            
-            if send_reply(sender_address, subject, generated_answer):
-                mail.store(email_id, '+FLAGS', '\\Seen')
-                processed_count += 1
-
-        mail.logout()
-        return f"Successfully processed {processed_count} of {len(email_ids)} email(s)."
+        if mail.enable_compression():
+            print("IMAP COMPRESS=DEFLATE enabled.")
+        _imap_conn = mail
+
+    if _imap_conn.state != 'SELECTED':
+        _imap_conn.select('inbox')
+    return _imap_conn
+
+def close_imap_connection():
+    """Logs out of the shared IMAP connection, ignoring errors from an already dead socket."""
+    global _imap_conn
+    if _imap_conn is None:
+        return
+    try:
+        _imap_conn.logout()
+    except Exception:
+        pass
+    _imap_conn = None
+
+atexit.register(close_imap_connection)
+
+def _batched(items, size):
+    """Yields successive lists of at most `size` items."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def process_email(sender_address, subject, body):
+    """Retrieves context for one email, generates a reply and sends it. Returns True if the reply was sent."""
+    print(f"\n--- Processing email from: {sender_address} ---")
+    user_query = f"Subject: {subject}\n\n{body}"
 
+    # If the user's entire message is just a greeting, provide a canned response.
+    if is_greeting(subject, body):
+        print("Detected simple greeting. Replying with a standard greeting.")
+        return send_reply(sender_address, subject, GREETING_REPLY)
+
+    generated_answer = get_cached_reply(user_query)
+    if generated_answer is None:
+        # Embed once and reuse the vector for both the semantic cache and the search.
+        query_embedding = knowledge_base.embeddings.embed_query(user_query)
+        generated_answer = get_cached_reply(user_query, query_embedding)
+
+    if generated_answer is None:
+        retrieved_docs = knowledge_base.similarity_search_by_vector(query_embedding, k=3)
+        context = "\n\n".join([doc.page_content for doc in retrieved_docs])
+        generated_answer = generate_gemini_reply(context, user_query, query_embedding)
+    else:
+        print("Reusing cached reply for a previously answered question.")
+
+    return send_reply(sender_address, subject, generated_answer)
+
+@contextmanager
+def _cross_process_check_lock():
+    """
+    Yields True if this process now holds the email-check lock, or False if a check
+    is already running in another worker process. The lock is non-blocking because
+    waiting on flock would stall every request in a gevent worker.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(CHECK_LOCK_PATH, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _mark_seen(uids):
+    """Flags messages \\Seen so later checks skip them, reconnecting if the connection dropped."""
+    if not uids:
+        return
+    try:
+        mail = get_imap_connection()
+        for batch in _batched(uids, FETCH_BATCH_SIZE):
+            mail.uid('STORE', b','.join(batch), '+FLAGS', '\\Seen')
     except Exception as e:
-        print(f"An unhandled error occurred: {e}")
-        return f"An error occurred: {e}"
+        print(f"Failed to mark {len(uids)} email(s) as read: {e}")
+        close_imap_connection()
+
+def check_and_process_emails():
+    """The core logic to fetch and process unread emails."""
+    print("\nChecking for new emails...")
+    # Checks are serialized: the IMAP connection is shared and two concurrent runs
+    # would otherwise pick up (and reply to) the same unread emails. Within a process
+    # later checks wait their turn; a check in another worker process makes this one a no-op.
+    with _imap_lock, _cross_process_check_lock() as acquired:
+        if not acquired:
+            print("Another worker is already checking emails. Skipping.")
+            return "An email check is already in progress."
+
+        futures = {}
+        unanswerable_uids = []
+        error_message = None
+        try:
+            mail = get_imap_connection()
+            # UIDs (unlike sequence numbers) stay valid across reconnects and expunges.
+            status, messages = mail.uid('SEARCH', None, 'UNSEEN')
+            if status != 'OK' or not messages[0]:
+                print("No new unread emails.")
+                return "No new emails to process."
+
+            uids = messages[0].split()
+            print(f"Found {len(uids)} new email(s).")
+
+            # Emails are handed to the worker pool as soon as their batch is fetched, so the
+            # network-bound retrieval, Gemini and SMTP calls of several emails overlap with
+            # each other and with the FETCH of the next batch. The IMAP connection itself is
+            # only ever used from this thread.
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_EMAILS) as executor:
+                # Fetch messages in batches: a few round-trips per batch instead of one per email.
+                for batch in _batched(uids, FETCH_BATCH_SIZE):
+                    for uid, raw_email in fetch_text_messages(mail, batch):
+                        try:
+                            parsed = parse_email(raw_email)
+                        except Exception as e:
+                            print(f"Failed to parse email {uid.decode()}: {e}")
+                            parsed = None
+                        if parsed is None:
+                            # It can never be answered; flag it so it isn't fetched on every check.
+                            unanswerable_uids.append(uid)
+                            continue
+                        futures[executor.submit(process_email, *parsed)] = uid
+
+        except Exception as e:
+            print(f"An unhandled error occurred: {e}")
+            # Drop the connection so the next check starts from a clean session.
+            close_imap_connection()
+            error_message = f"An error occurred: {e}"
+
+        # Replies already sent are flagged even when the check failed partway through;
+        # otherwise the next check would answer the same emails again.
+        replied_uids = []
+        for future, uid in futures.items():
+            try:
+                if future.result():
+                    replied_uids.append(uid)
+            except Exception as e:
+                print(f"Failed to process email {uid.decode()}: {e}")
+        _mark_seen(replied_uids + unanswerable_uids)
+
+        return error_message or f"Successfully processed {len(replied_uids)} of {len(uids)} email(s)."
 
 # --- API Endpoint Definition ---
 @app.route('/trigger-email-check', methods=['POST'])
@@ -229,4 +602,6 @@ if __name__ == '__main__':
         port = int(os.getenv('FLASK_RUN_PORT', 6004))
         # Initialize the knowledge base once on startup
         initialize_knowledge_base()
-        app.run(host='0.0.0.0', port=port, debug=True)
+        # Development server only; set FLASK_DEBUG=1 for the debugger and reloader.
+        # Use gunicorn with gunicorn_conf.py in production.
+        app.run(host='0.0.0.0', port=port)
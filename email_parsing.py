@@ -0,0 +1,83 @@
+"""
+Email text handling for the email replier.
+
+Turns a raw RFC822 message into the sender, subject and plain-text question that
+is sent to the model, trimming quoted reply chains so old mail isn't re-sent as
+prompt tokens, and spots emails that are only a greeting.
+"""
+import email
+import email.header
+import email.utils
+import re
+from email.iterators import typed_subpart_iterator
+
+# --- Greeting Detection ---
+# Matches messages that are only a greeting: "how are you", or "hi"/"hello"/"hey"
+# followed by at most one other word (e.g. "Hi there!", "hello Arya").
+GREETING_RE = re.compile(r"^\W*(?:how\s+are\s+you|(?:hi|hello|hey)(?:\W+\w+)?)\W*$", re.IGNORECASE)
+
+def is_greeting(subject, body):
+    """True if the email is only small talk: checks the body, or the subject when the body is empty."""
+    return bool(GREETING_RE.match(body.strip() or subject))
+
+# --- Body Extraction ---
+# Attribution line that starts a quoted reply chain, e.g.
+# "On Mon, 1 Jan 2024 at 10:00, Name <a@b.com> wrote:". Mail clients may wrap it
+# onto one extra line, but it never spans more than two lines.
+QUOTED_REPLY_RE = re.compile(r"^On [^\n]{1,200}(?:\n[^\n]{1,200})? wrote:[ \t]*$", re.MULTILINE)
+
+def _strip_quoted_reply(body):
+    """
+    Cuts the body at the first quoted reply chain. An attribution only counts if it
+    names an email address or is followed by ">"-quoted lines, and never at the very
+    start, so a customer's own "On <date> ... wrote:" sentences are kept.
+    """
+    # Decoded payloads keep the wire's CRLF line endings, which "$" would never match.
+    body = body.replace('\r\n', '\n')
+    for match in QUOTED_REPLY_RE.finditer(body):
+        if match.start() == 0:
+            continue
+        if '@' in match.group(0) or body[match.end():].lstrip().startswith('>'):
+            return body[:match.start()].rstrip()
+    return body
+
+def _extract_plain(msg):
+    """
+    Returns the first text/plain part of a message, decoded with its declared charset,
+    with any quoted reply chain removed to keep the prompt small.
+    """
+    part = next(typed_subpart_iterator(msg, 'text', 'plain'), None)
+    if part is None:
+        # Single-part text message (e.g. text/html): use its payload as before. Anything
+        # else, like a bare PDF or image, has no text to answer.
+        if msg.is_multipart() or msg.get_content_maintype() != 'text':
+            return ""
+        part = msg
+
+    payload = part.get_payload(decode=True) or b""
+    try:
+        body = payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:
+        body = payload.decode('utf-8', errors='replace')
+
+    return _strip_quoted_reply(body)
+
+def parse_email(raw_email):
+    """
+    Extracts the sender address, subject and plain-text body from a raw RFC822 message.
+    Returns None if the message has no usable sender address.
+    """
+    msg = email.message_from_bytes(raw_email)
+
+    from_header = email.utils.getaddresses([msg['From'] or ''])
+    if not from_header: return None
+    sender_name, sender_address = from_header[0]
+    if '@' not in sender_address: return None
+
+    subject_header = email.header.decode_header(msg['Subject'] or '')
+    subject = subject_header[0][0]
+    if isinstance(subject, bytes): subject = subject.decode(subject_header[0][1] or 'utf-8')
+
+    body = _extract_plain(msg)
+
+    return sender_address, subject, body
@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for serving the email replier in production.
+
+Run with:
+    gunicorn -c gunicorn_conf.py app:app
+"""
+# Patch the standard library before app.py imports imaplib, smtplib and requests,
+# so their socket waits yield to other greenlets instead of blocking the worker.
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('FLASK_RUN_PORT', 6004)}"
+worker_class = "gevent"
+# Each worker keeps its own IMAP/SMTP connections; app.py takes a file lock so
+# only one worker at a time runs an email check.
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_connections = 100
+# A check over a full inbox can take a while; don't let the arbiter kill it.
+timeout = 120
+# Import app.py once in the master and fork workers from it, so the embedding
+# model is loaded a single time and shared copy-on-write (PyTorch backend only;
+# ONNX sessions are created per worker). Connections (LanceDB, IMAP, SMTP, HTTP)
+# are still opened lazily inside each worker.
+preload_app = True
+os.environ.setdefault('PRELOAD_EMBEDDING_MODEL', '1')
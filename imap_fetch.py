@@ -0,0 +1,161 @@
+"""
+Narrow IMAP fetching for the email replier.
+
+Only the From/Subject headers and the text/plain body part of each message are
+downloaded, so attachments and HTML alternatives never cross the wire. Messages
+are addressed by UID, which stays valid across reconnects, and BODY.PEEK leaves
+the \\Seen flag alone; it is set explicitly once a reply has been sent.
+"""
+import re
+from itertools import takewhile
+
+_IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+_IMAP_MESSAGE_START_RE = re.compile(rb'^\d+ \(')
+_IMAP_UID_RE = re.compile(rb'\bUID (\d+)', re.IGNORECASE)
+_IMAP_LITERAL_RE = re.compile(rb'\{\d+\}$')
+
+def _join_imap_response(data):
+    """Joins imaplib FETCH response items into one buffer, inlining literals as quoted strings."""
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            quoted = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            chunks.append(_IMAP_LITERAL_RE.sub(b'', prefix) + b'"' + quoted + b'"')
+        elif item:
+            chunks.append(item)
+    return b' '.join(chunks)
+
+def _parse_imap_list(data):
+    """Parses IMAP parenthesized lists into nested Python lists of bytes (NIL becomes None)."""
+    stack = [[]]
+    pos = 0
+    while match := _IMAP_TOKEN_RE.match(data, pos):
+        pos = match.end()
+        open_paren, close_paren, quoted, atom = match.groups()
+        if open_paren:
+            stack.append([])
+        elif close_paren:
+            if len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted))
+        else:
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+    return stack[0]
+
+def _find_text_part(structure, section=""):
+    """
+    Walks a parsed BODYSTRUCTURE and returns (section, content_type, charset, encoding)
+    for the first inline text/plain part, or None. A single-part text message is always
+    part "1"; a single-part PDF, image or other binary has no text part.
+    """
+    if isinstance(structure[0], list):
+        # Multipart: child parts come first, followed by the subtype and extension data.
+        children = takewhile(lambda item: isinstance(item, list), structure)
+        for index, child in enumerate(children, 1):
+            found = _find_text_part(child, f"{section}.{index}" if section else str(index))
+            if found:
+                return found
+        return None
+
+    content_type = b'/'.join(structure[:2]).lower()
+    disposition = structure[9] if len(structure) > 9 else None
+    is_attachment = isinstance(disposition, list) and (disposition[0] or b'').lower() == b'attachment'
+    if is_attachment:
+        return None
+    # A single-part text message keeps its old behaviour of using whatever text it has.
+    if content_type != b'text/plain' and (section or not content_type.startswith(b'text/')):
+        return None
+
+    params = structure[2] or []
+    charset = dict(zip((key.upper() for key in params[::2]), params[1::2])).get(b'CHARSET')
+    return section or "1", content_type, charset, structure[5] or b'7BIT'
+
+def _split_fetch_responses(data):
+    """Splits imaplib FETCH response items into one list of items per message."""
+    messages = []
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        if not line:
+            continue
+        if _IMAP_MESSAGE_START_RE.match(line) or not messages:
+            messages.append([])
+        messages[-1].append(item)
+    return messages
+
+def fetch_text_messages(mail, uids):
+    """
+    Fetches the From/Subject headers and the text/plain part of each message by UID.
+    Returns (uid, raw_email) pairs, where raw_email is a minimal RFC822 message.
+    """
+    status, data = mail.uid('FETCH', b','.join(uids), '(BODYSTRUCTURE)')
+    if status != 'OK':
+        print(f"Failed to fetch the structure of {len(uids)} email(s).")
+        return []
+
+    # imaplib also hands back unsolicited FETCH responses (e.g. FLAGS updates queued
+    # by an earlier NOOP), so only requested UIDs that carry a BODYSTRUCTURE count.
+    requested = set(uids)
+    text_parts = {}
+    for attributes in _parse_imap_list(_join_imap_response(data)):
+        if not isinstance(attributes, list):
+            continue
+        fields = dict(zip((key.upper() if isinstance(key, bytes) else key for key in attributes[::2]), attributes[1::2]))
+        uid, structure = fields.get(b'UID'), fields.get(b'BODYSTRUCTURE')
+        if uid in requested and isinstance(structure, list) and structure:
+            text_parts[uid] = _find_text_part(structure)
+
+    # Messages are grouped by the section holding their text so each group needs one FETCH.
+    uids_by_section = {}
+    for uid, text_part in text_parts.items():
+        uids_by_section.setdefault(text_part[0] if text_part else None, []).append(uid)
+
+    headers, bodies = {}, {}
+    for section, section_uids in uids_by_section.items():
+        items = 'BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]'
+        if section:
+            items += f' BODY.PEEK[{section}]'
+        status, data = mail.uid('FETCH', b','.join(section_uids), f'({items})')
+        if status != 'OK':
+            print(f"Failed to fetch {len(section_uids)} email(s).")
+            continue
+
+        wanted = set(section_uids)
+        for message in _split_fetch_responses(data):
+            uid, header, body = None, None, None
+            for item in message:
+                line = item[0] if isinstance(item, tuple) else item
+                # The UID item may come before or after the literals.
+                uid_match = uid is None and _IMAP_UID_RE.search(line)
+                if uid_match:
+                    uid = uid_match.group(1)
+                # Only literals carry content; inline NIL or "" values leave the defaults in place.
+                if isinstance(item, tuple):
+                    if b'HEADER.FIELDS' in line.upper():
+                        header = item[1]
+                    else:
+                        body = item[1]
+            if uid not in wanted:
+                continue
+            if header is not None:
+                headers[uid] = header
+            if body is not None:
+                bodies[uid] = body
+
+    messages = []
+    for uid in uids:
+        if uid not in headers:
+            continue
+        # Rebuild a small RFC822 message so parse_email can decode it like a full one.
+        raw_email = headers[uid].rstrip(b'\r\n') + b'\r\nMIME-Version: 1.0\r\n'
+        text_part = text_parts.get(uid)
+        if text_part:
+            _, content_type, charset, encoding = text_part
+            raw_email += b'Content-Type: ' + content_type
+            if charset:
+                raw_email += b'; charset="' + charset + b'"'
+            raw_email += b'\r\nContent-Transfer-Encoding: ' + encoding + b'\r\n'
+        messages.append((uid, raw_email + b'\r\n' + bodies.get(uid, b'')))
+    return messages
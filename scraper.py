@@ -2,9 +2,25 @@ import requests
 from bs4 import BeautifulSoup
 import lancedb
 import os
+import re
+import math
 from langchain_community.vectorstores import LanceDB
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
+from dotenv import load_dotenv
+
+# Collapses runs of whitespace in scraped text to a single space.
+_WS = re.compile(r'\s+')
+
+# FAQ entries longer than this are split into smaller chunks before embedding.
+MAX_DOCUMENT_CHARS = 1500
+
+# Product quantization needs at least this many vectors to train its codebooks;
+# below it a brute-force scan is already fast, so no ANN index is built.
+MIN_ROWS_FOR_ANN_INDEX = 256
+
+# Load environment variables from .env file so the embedding settings match app.py
+load_dotenv()
 
 def scrape_pnb_faqs(url):
     """
@@ -30,7 +46,8 @@ def scrape_pnb_faqs(url):
         print(f"Error fetching the URL: {e}")
         return []
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+    # lxml's C parser is much faster and lighter on memory than the pure-Python html.parser.
+    soup = BeautifulSoup(response.content, 'lxml')
 
     faq_data = []
     
@@ -38,7 +55,7 @@ def scrape_pnb_faqs(url):
     target_keywords = ['home loan', 'fixed deposit']
 
     # Find all potential FAQ sections on the page
-    all_sections = soup.find_all('div', class_='tabReapeate')
+    all_sections = soup.select('div.tabReapeate')
     
     if not all_sections:
         print("Error: Could not find any FAQ section containers with class 'tabReapeate'.")
@@ -58,17 +75,17 @@ def scrape_pnb_faqs(url):
             print(f"\n--- Processing Section: {heading_tag.get_text(strip=True)} ---")
             
             # Find all question containers within this specific section
-            question_containers = section.find_all('div', class_='question')
+            question_containers = section.select('div.question')
             
             for q_container in question_containers:
-                question_tag = q_container.find('div', class_='QuesLists')
+                question_tag = q_container.select_one('div.QuesLists')
                 answer_container = q_container.find_next_sibling('div', class_='answer')
 
                 if question_tag and answer_container:
-                    answer_tag = answer_container.find('div', class_='AnsLists')
+                    answer_tag = answer_container.select_one('div.AnsLists')
                     if answer_tag:
-                        question = ' '.join(question_tag.get_text(strip=True).split())
-                        answer = ' '.join(answer_tag.get_text(strip=True).split())
+                        question = _WS.sub(' ', question_tag.get_text(strip=True)).strip()
+                        answer = _WS.sub(' ', answer_tag.get_text(strip=True)).strip()
                         
                         if question and answer:
                             full_text = f"Question: {question} Answer: {answer}"
@@ -99,12 +116,32 @@ def create_lancedb_knowledge_base(documents):
         chunk_overlap=150,
         length_function=len
     )
-    chunks = text_splitter.split_text('\n\n'.join(documents))
-    print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
+    # Each FAQ is already a self-contained Q&A pair, so it is embedded as-is. Only
+    # unusually long entries are split, which keeps unrelated FAQs out of one chunk.
+    chunks = []
+    for document in documents:
+        if len(document) > MAX_DOCUMENT_CHARS:
+            chunks.extend(text_splitter.split_text(document))
+        else:
+            chunks.append(document)
+    print(f"Prepared {len(chunks)} chunks from {len(documents)} documents.")
 
     print("Loading embedding model (this may take a moment on first run)...")
     model_name = "sentence-transformers/all-MiniLM-L6-v2"
-    embeddings = HuggingFaceEmbeddings(model_name=model_name)
+    # Reuse the same persistent model cache as app.py so the weights are downloaded only once.
+    cache_folder = os.getenv('HF_HOME', '/tmp/hf_cache')
+    model_kwargs = {"device": "cpu"}
+    # Optionally embed with the int8-quantized ONNX export; app.py must use the same backend.
+    if os.getenv('EMBEDDING_BACKEND', 'torch') == 'onnx':
+        onnx_file = os.getenv('EMBEDDING_ONNX_FILE', 'onnx/model_quint8_avx2.onnx')
+        model_kwargs.update(backend="onnx", model_kwargs={"file_name": onnx_file})
+    embeddings = HuggingFaceEmbeddings(
+        model_name=model_name,
+        cache_folder=cache_folder,
+        model_kwargs=model_kwargs,
+        # Ingestion embeds every chunk in one go; larger batches amortize per-batch overhead.
+        encode_kwargs={"normalize_embeddings": True, "batch_size": 128, "convert_to_numpy": True},
+    )
     print("Embedding model loaded.")
 
     # Setup LanceDB
@@ -121,6 +158,22 @@ def create_lancedb_knowledge_base(documents):
 
     print("Creating LanceDB vector store...")
     vector_store = LanceDB.from_texts(chunks, embeddings, connection=db, table_name=table_name)
+
+    # Build an IVF_PQ index so queries scan a few partitions instead of every vector.
+    # Embeddings are normalized, so L2 (the metric LangChain queries with) ranks like cosine.
+    table = db.open_table(table_name)
+    row_count = table.count_rows()
+    if row_count >= MIN_ROWS_FOR_ANN_INDEX:
+        num_partitions = min(64, int(math.sqrt(row_count)))
+        print(f"Building IVF_PQ index with {num_partitions} partitions over {row_count} vectors...")
+        table.create_index(
+            metric="L2",
+            vector_column_name="vector",
+            num_partitions=num_partitions,
+            num_sub_vectors=48,
+        )
+    else:
+        print(f"Skipping ANN index: {row_count} vectors is below {MIN_ROWS_FOR_ANN_INDEX}, brute-force search is used.")
     print("Knowledge base created successfully in LanceDB!")
 
     return vector_store
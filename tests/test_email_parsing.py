@@ -0,0 +1,61 @@
+import unittest
+
+from email_parsing import _strip_quoted_reply, is_greeting, parse_email
+
+
+class StripQuotedReplyTest(unittest.TestCase):
+    def test_strips_lf_reply_chain(self):
+        body = "What are FD rates?\n\nOn Mon, 1 Jan 2024 at 10:00, Bank <b@y.com> wrote:\n> old text\n"
+        self.assertEqual(_strip_quoted_reply(body), "What are FD rates?")
+
+    def test_strips_crlf_reply_chain(self):
+        body = "What are FD rates?\r\n\r\nOn Mon, 1 Jan 2024 at 10:00, Bank <b@y.com> wrote:\r\n> old text\r\n"
+        self.assertEqual(_strip_quoted_reply(body), "What are FD rates?")
+
+    def test_strips_wrapped_attribution(self):
+        body = "Is prepayment allowed?\n\nOn Mon, 1 Jan 2024 at 10:00, PNB Housing\n<care@pnbhfl.com> wrote:\n> old text\n"
+        self.assertEqual(_strip_quoted_reply(body), "Is prepayment allowed?")
+
+    def test_keeps_customers_own_wrote_sentence(self):
+        body = ("On Monday I wrote: please close my FD.\n"
+                "On Tuesday my branch manager wrote:\n"
+                "nothing yet. Can you check the status?\n")
+        self.assertEqual(_strip_quoted_reply(body), body)
+
+    def test_keeps_attribution_at_start(self):
+        body = "On Mon, 1 Jan 2024, you <b@y.com> wrote:\nWhat about the rates?\n"
+        self.assertEqual(_strip_quoted_reply(body), body)
+
+
+class IsGreetingTest(unittest.TestCase):
+    def test_greeting_in_body(self):
+        self.assertTrue(is_greeting("Question", "Hi there!"))
+
+    def test_greeting_in_subject_with_empty_body(self):
+        self.assertTrue(is_greeting("Hello", "  \r\n"))
+
+    def test_question_is_not_a_greeting(self):
+        self.assertFalse(is_greeting("Hi", "What are the current FD rates?"))
+        self.assertFalse(is_greeting("Hello", "Hi, what is the home loan interest rate?"))
+
+
+class ParseEmailTest(unittest.TestCase):
+    def test_crlf_body_is_stripped(self):
+        raw = (b"From: Customer <c@example.com>\r\nSubject: FD rates\r\n"
+               b"Content-Type: text/plain; charset=utf-8\r\n\r\n"
+               b"What are FD rates?\r\n\r\nOn Mon, 1 Jan 2024 at 10:00, Bank <b@y.com> wrote:\r\n> old text\r\n")
+        self.assertEqual(parse_email(raw), ("c@example.com", "FD rates", "What are FD rates?"))
+
+    def test_single_part_binary_has_no_body(self):
+        raw = (b"From: c@example.com\r\nSubject: Statement\r\n"
+               b"Content-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n\r\n"
+               b"JVBERi0xLjQKJcfs\r\n")
+        self.assertEqual(parse_email(raw), ("c@example.com", "Statement", ""))
+
+    def test_missing_subject(self):
+        raw = b"From: c@example.com\r\n\r\nHello\r\n"
+        self.assertEqual(parse_email(raw), ("c@example.com", "", "Hello\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
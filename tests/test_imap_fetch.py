@@ -0,0 +1,144 @@
+import unittest
+
+from imap_fetch import _find_text_part, _parse_imap_list, fetch_text_messages
+
+
+def header(uid):
+    return b'From: Customer <c%s@example.com>\r\nSubject: FD rates\r\n\r\n' % uid
+
+
+class FakeIMAP:
+    """Replays imaplib-shaped UID FETCH responses and records the commands sent."""
+
+    def __init__(self, structure_data, bodies, extra=()):
+        self.structure_data = structure_data
+        self.bodies = bodies
+        self.extra = list(extra)
+        self.commands = []
+
+    def uid(self, command, message_set, items):
+        self.commands.append((command, message_set, items))
+        if items == '(BODYSTRUCTURE)':
+            return 'OK', self.structure_data
+        data = list(self.extra)
+        for uid in message_set.split(b','):
+            head = header(uid)
+            data.append((b'%d (UID %s BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}' % (len(data) + 1, uid, len(head)), head))
+            if 'BODY.PEEK[1' in items:
+                body = self.bodies[uid]
+                section = items.split('BODY.PEEK[')[2].rstrip('])')
+                data.append((b' BODY[%s] {%d}' % (section.encode(), len(body)), body))
+            data.append(b')')
+        return 'OK', data
+
+
+class ParseImapListTest(unittest.TestCase):
+    def test_nested_lists_quoted_strings_and_nil(self):
+        self.assertEqual(
+            _parse_imap_list(b'1 (UID 7 X "a\\"b" NIL (c))'),
+            [b'1', [b'UID', b'7', b'X', b'a"b', None, [b'c']]],
+        )
+
+
+class FindTextPartTest(unittest.TestCase):
+    def test_nested_multipart_skips_attachment(self):
+        structure = _parse_imap_list(
+            b'((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "BASE64" 20 1 NIL NIL NIL NIL) "MIXED")'
+            b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 99 NIL ("ATTACHMENT" NIL) NIL NIL) "MIXED")'
+        )[0]
+        self.assertEqual(_find_text_part(structure), ("1.1", b'text/plain', b'UTF-8', b'BASE64'))
+
+    def test_plain_attachment_is_not_the_body(self):
+        structure = _parse_imap_list(
+            b'(("TEXT" "HTML" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL)'
+            b'("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL ("ATTACHMENT" NIL) NIL NIL) "MIXED")'
+        )[0]
+        self.assertIsNone(_find_text_part(structure))
+
+    def test_single_part_message_is_part_one(self):
+        structure = _parse_imap_list(b'("TEXT" "HTML" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)')[0]
+        self.assertEqual(_find_text_part(structure), ("1", b'text/html', None, b'7BIT'))
+
+    def test_single_part_binary_has_no_text_part(self):
+        structure = _parse_imap_list(b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 4000000 NIL NIL NIL NIL)')[0]
+        self.assertIsNone(_find_text_part(structure))
+
+
+class FetchTextMessagesTest(unittest.TestCase):
+    def test_literal_in_bodystructure(self):
+        structure_data = [
+            (b'1 (UID 10 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "ISO-8859-1") NIL NIL "QUOTED-PRINTABLE" 9 1 NIL NIL NIL NIL)'
+             b'("APPLICATION" "PDF" ("NAME" {7}', b'a"b.pdf'),
+            b') NIL NIL "BASE64" 99 NIL ("ATTACHMENT" NIL) NIL NIL) "MIXED"))',
+        ]
+        mail = FakeIMAP(structure_data, {b'10': b'caf=E9?\r\n'})
+        [(uid, raw_email)] = fetch_text_messages(mail, [b'10'])
+        self.assertEqual(uid, b'10')
+        self.assertIn(b'Content-Type: text/plain; charset="ISO-8859-1"', raw_email)
+        self.assertIn(b'Content-Transfer-Encoding: QUOTED-PRINTABLE', raw_email)
+        self.assertTrue(raw_email.endswith(b'\r\n\r\ncaf=E9?\r\n'))
+        self.assertEqual(mail.commands[1][2], '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)] BODY.PEEK[1])')
+
+    def test_groups_fetches_by_section(self):
+        structure_data = [
+            b'1 (UID 10 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))',
+            b'2 (UID 11 BODYSTRUCTURE ((("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL) "ALTERNATIVE") "MIXED"))',
+            b'3 (UID 12 BODYSTRUCTURE (("IMAGE" "PNG" NIL NIL NIL "BASE64" 9 NIL NIL NIL NIL) "MIXED"))',
+        ]
+        mail = FakeIMAP(structure_data, {b'10': b'one', b'11': b'two'})
+        messages = dict(fetch_text_messages(mail, [b'10', b'11', b'12']))
+        self.assertEqual(sorted(messages), [b'10', b'11', b'12'])
+        self.assertTrue(messages[b'11'].endswith(b'two'))
+        # No text part: headers only, empty body.
+        self.assertTrue(messages[b'12'].endswith(b'MIME-Version: 1.0\r\n\r\n'))
+        self.assertEqual(
+            sorted(items for _, _, items in mail.commands[1:]),
+            ['(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)] BODY.PEEK[1.1])',
+             '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)] BODY.PEEK[1])',
+             '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])'],
+        )
+
+    def test_unsolicited_fetch_responses_are_ignored(self):
+        structure_data = [
+            b'1 (UID 10 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))',
+            # Queued by an earlier NOOP: same message without a BODYSTRUCTURE, and an unrequested one.
+            b'1 (FLAGS (\\Seen))',
+            b'5 (UID 99 FLAGS ())',
+        ]
+        unsolicited = [b'5 (UID 99 FLAGS ())', b'1 (FLAGS ())']
+        mail = FakeIMAP(structure_data, {b'10': b'What are FD rates?'}, extra=unsolicited)
+        self.assertEqual(
+            fetch_text_messages(mail, [b'10']),
+            [(b'10', header(b'10').rstrip(b'\r\n') + b'\r\nMIME-Version: 1.0\r\nContent-Type: text/plain'
+              b'\r\nContent-Transfer-Encoding: 7BIT\r\n\r\nWhat are FD rates?')],
+        )
+        self.assertEqual([message_set for _, message_set, _ in mail.commands], [b'10', b'10'])
+
+    def test_uid_after_literals(self):
+        structure_data = [b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL) UID 10)']
+
+        class UidLastIMAP(FakeIMAP):
+            def uid(self, command, message_set, items):
+                if items == '(BODYSTRUCTURE)':
+                    return 'OK', self.structure_data
+                head = header(b'10')
+                return 'OK', [
+                    (b'1 (BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}' % len(head), head),
+                    (b' BODY[1] {5}', b'hello'),
+                    b' UID 10)',
+                ]
+
+        [(uid, raw_email)] = fetch_text_messages(UidLastIMAP(structure_data, {}), [b'10'])
+        self.assertEqual(uid, b'10')
+        self.assertTrue(raw_email.endswith(b'hello'))
+
+    def test_failed_structure_fetch_returns_nothing(self):
+        class FailingIMAP:
+            def uid(self, *args):
+                return 'NO', [None]
+
+        self.assertEqual(fetch_text_messages(FailingIMAP(), [b'10']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()